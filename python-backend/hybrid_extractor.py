@@ -1,10 +1,170 @@
+import asyncio
+import contextlib
 import fitz  # PyMuPDF
+import numpy as np
+import google.auth
+from google.api_core.exceptions import ResourceExhausted
 from google.cloud import vision
+from google.cloud.vision_v1 import ImageAnnotatorAsyncClient
+from google.cloud.vision_v1.services.image_annotator.transports import (
+    ImageAnnotatorGrpcAsyncIOTransport,
+    ImageAnnotatorGrpcTransport
+)
+from cachetools import LRUCache
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import hashlib
+import multiprocessing
+import os
 import re
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Nombre maximum de processus pour le traitement parallèle des pages
+MAX_WORKERS = 4
+
+# Nombre maximum de pools de processus actifs en même temps, toutes requêtes
+# confondues (au plus MAX_PARALLEL_POOLS * MAX_WORKERS processus) : chaque
+# worker garde sa propre copie du PDF, les documents suivants attendent
+MAX_PARALLEL_POOLS = 2
+
+# En dessous de ce nombre de pages, le classement se fait dans le processus
+# courant : lancer les workers coûterait plus que le travail lui-même
+PARALLEL_MIN_PAGES = 8
+
+# Nombre maximum d'images par requête BatchAnnotateImages (limite de l'API Vision)
+OCR_BATCH_SIZE = 16
+
+# Nombre maximum de lots OCR en vol simultanément (client Vision asynchrone)
+OCR_MAX_CONCURRENCY = 8
+
+# Threads d'envoi des lots OCR pendant que le rendu des pages suivantes continue
+OCR_PIPELINE_WORKERS = 2
+
+# Rendu des pages pour l'OCR : zoom 2x (≈ 200 DPI sur une page Letter) et JPEG,
+# suffisant pour Vision et bien plus léger à encoder et à envoyer que du PNG 3x
+DPI_MATRIX = fitz.Matrix(2, 2)
+JPEG_QUALITY = 85
+
+# Page rendue considérée comme blanche (OCR inutile) : quasi uniforme et claire
+BLANK_MIN_MEAN = 250
+BLANK_MAX_STD = 5
+
+# Sur une page avec du texte, une image couvrant moins de cette part de la page
+# (logo, pictogramme...) ne justifie pas l'OCR
+MIN_IMAGE_AREA_RATIO = 0.05
+
+# Options d'extraction du texte (sert aussi au test "page avec texte") : celles
+# de get_text("text") par défaut, sans TEXT_PRESERVE_LIGATURES. Ce n'est pas
+# un gain de vitesse mais une normalisation voulue : les ligatures sont
+# décomposées ("ﬁ" -> "fi"), comme dans le texte OCR, pour que la fusion
+# hybride et la comparaison ne voient pas de fausses différences
+TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+# Canal gRPC Vision : keepalive pour éviter que la connexion HTTP/2 soit
+# fermée entre deux rafales de requêtes, et tailles de message illimitées
+# (options par défaut du transport, remplacées quand on fournit le canal) :
+# une réponse DOCUMENT_TEXT_DETECTION de 16 images dépasse vite les 4 Mo
+VISION_ENDPOINT = "vision.googleapis.com:443"
+VISION_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+# Cache disque des résultats OCR : un fichier {sha256(image)}.txt par image
+OCR_CACHE_DIR = os.path.expanduser("~/.cache/pdf-comparator/ocr")
+
+# Nombre d'images gardées dans le cache mémoire (les plus récentes) : le
+# serveur garde le même extracteur, le disque prend le relais au-delà
+OCR_CACHE_MAX_ENTRIES = 1024
+
+# Prix Vision DOCUMENT_TEXT_DETECTION par image envoyée (les images servies
+# depuis le cache et les pages blanches ne sont pas facturées)
+OCR_COST_PER_IMAGE = 0.0015
+
+# Correspondance méthode d'extraction -> compteur dans les statistiques
+METHOD_STATS = {
+    'direct_text': 'text_extracted',
+    'ocr_only': 'ocr_used',
+    'hybrid': 'hybrid',
+    'empty': 'empty'
+}
+
+
+def create_vision_client():
+    """
+    Crée le client Vision sur un canal gRPC configuré avec keepalive
+    """
+    channel = ImageAnnotatorGrpcTransport.create_channel(
+        VISION_ENDPOINT,
+        options=VISION_CHANNEL_OPTIONS
+    )
+    return vision.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+
+
+def create_vision_async_client(credentials=None):
+    """
+    Crée le client Vision asynchrone (grpc.aio), même configuration de canal
+    À appeler dans la boucle d'événements qui l'utilise (le canal s'y attache)
+    """
+    channel = ImageAnnotatorGrpcAsyncIOTransport.create_channel(
+        VISION_ENDPOINT,
+        credentials=credentials,
+        options=VISION_CHANNEL_OPTIONS
+    )
+    return ImageAnnotatorAsyncClient(transport=ImageAnnotatorGrpcAsyncIOTransport(channel=channel))
+
+
+_POOL_SLOTS = threading.BoundedSemaphore(MAX_PARALLEL_POOLS)
+
+# Les pools sont lancés depuis des threads, à côté des canaux gRPC : un fork
+# copierait leur état (verrous, threads) dans les workers. Ils partent donc du
+# serveur forkserver (ou spawn s'il n'existe pas), qui importe ce module une
+# seule fois au lieu de le faire à chaque worker
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+if __name__ != "__main__":
+    _MP_CONTEXT.set_forkserver_preload([__name__])
+
+# État propre à chaque processus worker (initialisé par _init_worker)
+_worker_extractor = None
+_worker_doc = None
+_worker_matrix = None
+
+_WS_RE = re.compile(r'\s+')
+
+
+def _normalize_line(line):
+    """
+    Normalise une ligne pour la comparaison texte direct / OCR
+    """
+    return _WS_RE.sub(' ', line.strip().lower())
+
+
+def _init_worker(pdf_bytes, matrix):
+    """
+    Initialise un processus worker : un extracteur et un document par processus
+    (PyMuPDF n'est pas thread-safe, chaque processus ouvre sa propre copie)
+    """
+    global _worker_extractor, _worker_doc, _worker_matrix
+    _worker_extractor = HybridPDFExtractor()
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    _worker_matrix = fitz.Matrix(*matrix)
+
+
+def _process_page(page_num):
+    """
+    Traite une page dans un processus worker (fonction top-level pour le pickling)
+    """
+    return _worker_extractor.process_page(_worker_doc[page_num], page_num, _worker_matrix)
+
 
 class HybridPDFExtractor:
     """
@@ -12,133 +172,521 @@ class HybridPDFExtractor:
     """
     
     def __init__(self, vision_client=None):
-        try:
-            self.vision_client = vision_client or vision.ImageAnnotatorClient()
-        except Exception as e:
-            print(f"⚠️ Vision API non disponible: {e}")
-            self.vision_client = None
+        # Client Vision créé à la première utilisation : les workers, qui ne
+        # font que classer et rendre les pages, n'en ont jamais besoin
+        self._vision_client = vision_client
+        self._vision_ready = vision_client is not None
+        # Les groupes OCR tournent sur plusieurs threads : un seul crée le client
+        self._vision_lock = threading.Lock()
+        # Client asynchrone, créé dans la boucle d'événements qui l'utilise
+        self._async_vision_client = None
+        self._async_vision_ready = False
+        self._async_vision_lock = asyncio.Lock()
+        self._ocr_semaphore = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+        # Les documents qui attendent un pool de processus attendent dans la
+        # boucle, sans occuper un thread de l'exécuteur par défaut
+        self._pool_slots = asyncio.Semaphore(MAX_PARALLEL_POOLS)
+        # Cache mémoire des résultats OCR (clé : sha256 de l'image), partagé
+        # par le thread de classement et ceux des lots OCR
+        self._ocr_cache = LRUCache(maxsize=OCR_CACHE_MAX_ENTRIES)
+        self._ocr_cache_lock = threading.Lock()
+        # Images en cours de reconnaissance, toutes extractions confondues
+        # (empreinte -> Future de son résultat) : une extraction concurrente
+        # qui rencontre la même image attend ce résultat au lieu de la renvoyer
+        self._ocr_inflight = {}
+    
+    @property
+    def vision_client(self):
+        with self._vision_lock:
+            if not self._vision_ready:
+                try:
+                    self._vision_client = create_vision_client()
+                except Exception as e:
+                    print(f"⚠️ Vision API non disponible: {e}")
+                    self._vision_client = None
+                self._vision_ready = True
+        return self._vision_client
+    
+    async def get_async_vision_client(self):
+        """
+        Retourne le client Vision asynchrone, créé à la première utilisation
+        La recherche des identifiants (fichier, serveur de métadonnées GCE...)
+        se fait dans un thread pour ne pas bloquer la boucle
+        """
+        async with self._async_vision_lock:
+            if not self._async_vision_ready:
+                try:
+                    credentials, _ = await asyncio.to_thread(google.auth.default)
+                    self._async_vision_client = create_vision_async_client(credentials)
+                except Exception as e:
+                    print(f"⚠️ Vision API (async) non disponible: {e}")
+                    self._async_vision_client = None
+                self._async_vision_ready = True
+        return self._async_vision_client
     
-    def has_extractable_text(self, page):
+    def has_extractable_text(self, text):
         """
-        Vérifie si la page contient du texte extractible
+        Vérifie si le texte extrait de la page est exploitable
         """
-        text = page.get_text().strip()
-        return len(text) > 50  # Seuil : minimum de caractères
+        return len(text.strip()) > 50  # Seuil : minimum de caractères
     
     def has_images(self, page):
         """
         Vérifie si la page contient des images
         """
-        image_list = page.get_images()
+        image_list = page.get_images(full=False)
         return len(image_list) > 0
     
     def extract_text_from_pdf(self, page):
         """
         Extrait le texte directement du PDF (rapide et gratuit)
         """
-        return page.get_text()
+        return page.get_text("text", flags=TEXT_FLAGS)
     
-    def extract_text_from_image_ocr(self, page, page_num):
+    def _needs_ocr(self, page):
         """
-        Extrait le texte en utilisant l'OCR (pour les pages avec images/tableaux)
+        Vérifie si la page doit passer par l'OCR (présence d'images)
         """
-        if not self.vision_client:
-            return "[OCR non disponible - Vision API non configurée]"
+        return self.has_images(page)
+    
+    def _is_blank(self, pix):
+        """
+        Vérifie si l'image rendue est (quasi) entièrement blanche
+        """
+        samples = np.frombuffer(pix.samples, dtype=np.uint8)
+        return samples.mean() > BLANK_MIN_MEAN and samples.std() < BLANK_MAX_STD
+    
+    def _image_region(self, page):
+        """
+        Retourne la zone de la page couverte par les images (union des bbox),
+        ou None si toutes les images sont trop petites pour justifier l'OCR
+        """
+        page_area = page.rect.get_area()
+        if not page_area:
+            return None
+        
+        region = None
+        has_large_image = False
+        for image_info in page.get_image_info():
+            # Les bbox sont en coordonnées non tournées, page.rect et le clip
+            # du rendu en coordonnées de la page affichée (/Rotate)
+            bbox = (fitz.Rect(image_info['bbox']) * page.rotation_matrix) & page.rect
+            if bbox.is_empty:
+                continue
+            if bbox.get_area() / page_area >= MIN_IMAGE_AREA_RATIO:
+                has_large_image = True
+            region = bbox if region is None else region | bbox
+        
+        return region if has_large_image else None
+    
+    def _render_page_image(self, page, matrix=DPI_MATRIX, clip=None):
+        """
+        Rend la page (ou seulement la zone clip) en image JPEG pour l'OCR
+        Retourne None si la page rendue est blanche (rien à reconnaître)
+        """
+        pix = page.get_pixmap(matrix=matrix, clip=clip)
+        if self._is_blank(pix):
+            return None
+        return pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
     
+    def _get_cached_ocr(self, img_hash):
+        """
+        Cherche le texte OCR d'une image dans le cache mémoire puis disque
+        Retourne None si l'image n'a jamais été traitée
+        """
+        with self._ocr_cache_lock:
+            text = self._ocr_cache.get(img_hash)
+        if text is not None:
+            return text
+        
+        cache_path = os.path.join(OCR_CACHE_DIR, f"{img_hash}.txt")
         try:
-            mat = fitz.Matrix(3, 3)
-            pix = page.get_pixmap(matrix=mat)
-            img_bytes = pix.tobytes("png")
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError:
+            return None
+        
+        with self._ocr_cache_lock:
+            self._ocr_cache[img_hash] = text
+        return text
+    
+    def _set_cached_ocr(self, img_hash, text):
+        """
+        Enregistre le texte OCR d'une image (écriture atomique sur disque)
+        """
+        with self._ocr_cache_lock:
+            self._ocr_cache[img_hash] = text
+        
+        try:
+            os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=OCR_CACHE_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, os.path.join(OCR_CACHE_DIR, f"{img_hash}.txt"))
+        except OSError as e:
+            print(f"⚠️ Cache OCR non écrit: {e}")
+    
+    @retry(
+        retry=retry_if_exception_type(ResourceExhausted),
+        wait=wait_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(5),
+        reraise=True
+    )
+    def _annotate_batch(self, requests):
+        """
+        Envoie un lot de requêtes à Vision (réessais espacés si quota dépassé)
+        """
+        return self.vision_client.batch_annotate_images(requests=requests)
+    
+    @retry(
+        retry=retry_if_exception_type(ResourceExhausted),
+        wait=wait_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(5),
+        reraise=True
+    )
+    async def _annotate_batch_async(self, client, requests):
+        """
+        Version asynchrone de _annotate_batch (nombre de lots en vol limité)
+        """
+        async with self._ocr_semaphore:
+            return await client.batch_annotate_images(requests=requests)
+    
+    def _ocr_requests(self, batch):
+        """
+        Construit les requêtes BatchAnnotateImages d'un lot
+        """
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        return [
+            vision.AnnotateImageRequest(image=vision.Image(content=img_bytes), features=[feature])
+            for _, img_bytes in batch
+        ]
+    
+    def _claim_ocr(self, img_hash):
+        """
+        Réserve l'OCR d'une image absente du cache
+        Retourne None si l'appelant doit l'envoyer lui-même, sinon un Future
+        du résultat déjà en cours (ou tout juste mis en cache) pour cette image
+        """
+        with self._ocr_cache_lock:
+            future = self._ocr_inflight.get(img_hash)
+            if future is not None:
+                return future
             
-            image = vision.Image(content=img_bytes)
-            response = self.vision_client.document_text_detection(image=image)
+            # Lot d'une autre extraction terminé depuis la lecture du cache
+            text = self._ocr_cache.get(img_hash)
+            if text is not None:
+                future = Future()
+                future.set_result(({img_hash: text}, {}))
+                return future
             
-            if response.error.message:
-                raise Exception(f'Erreur OCR: {response.error.message}')
+            self._ocr_inflight[img_hash] = Future()
+            return None
+    
+    def _release_ocr(self, batch, texts, errors):
+        """
+        Transmet le résultat d'un lot aux extractions qui attendent ses images
+        """
+        with self._ocr_cache_lock:
+            waiting = [(img_hash, self._ocr_inflight.pop(img_hash)) for img_hash, _ in batch]
+        for img_hash, future in waiting:
+            if img_hash in texts:
+                future.set_result(({img_hash: texts[img_hash]}, {}))
+            else:
+                future.set_result(({}, {img_hash: errors.get(img_hash)}))
+    
+    def _dispatch_ocr(self, dispatch, batch):
+        """
+        Confie un lot à dispatch et libère ses images une fois le lot traité
+        """
+        future = dispatch(batch)
+        
+        def release(done):
+            try:
+                texts, errors = done.result()
+            except Exception as e:
+                texts, errors = {}, dict.fromkeys((img_hash for img_hash, _ in batch), str(e))
+            self._release_ocr(batch, texts, errors)
+        
+        future.add_done_callback(release)
+        return future
+    
+    def _read_ocr_response(self, batch, response):
+        """
+        Répartit la réponse Vision d'un lot sur ses images (et met en cache)
+        Retourne (textes, erreurs), indexés par empreinte d'image
+        """
+        texts = {}
+        errors = {}
+        # Les réponses arrivent dans l'ordre des requêtes
+        for (img_hash, _), image_response in zip(batch, response.responses):
+            if image_response.error.message:
+                errors[img_hash] = image_response.error.message
+                continue
             
-            return response.full_text_annotation.text if response.full_text_annotation else ""
+            text = image_response.full_text_annotation.text if image_response.full_text_annotation else ""
+            self._set_cached_ocr(img_hash, text)
+            texts[img_hash] = text
+        
+        # Une réponse tronquée ne doit pas passer pour "Vision non configurée"
+        for img_hash, _ in batch[len(response.responses):]:
+            errors[img_hash] = "réponse Vision manquante"
+        return texts, errors
+    
+    def _run_ocr_batch(self, batch):
+        """
+        Extrait le texte d'un lot d'images (OCR_BATCH_SIZE au plus) en une
+        requête BatchAnnotateImages
+        batch : liste de (img_hash, img_bytes) - retourne (textes, erreurs),
+        indexés par empreinte (erreur à None : Vision n'est pas configurée)
+        """
+        if not self.vision_client:
+            return {}, dict.fromkeys((img_hash for img_hash, _ in batch), None)
         
+        try:
+            response = self._annotate_batch(self._ocr_requests(batch))
         except Exception as e:
-            return f"[Erreur OCR page {page_num + 1}: {str(e)}]"
+            return {}, dict.fromkeys((img_hash for img_hash, _ in batch), str(e))
+        return self._read_ocr_response(batch, response)
+    
+    async def _run_ocr_batch_async(self, batch):
+        """
+        Version asynchrone de _run_ocr_batch (sans bloquer la boucle : la
+        mise en cache des résultats, qui écrit sur disque, passe par un thread)
+        """
+        client = await self.get_async_vision_client()
+        if not client:
+            return {}, dict.fromkeys((img_hash for img_hash, _ in batch), None)
         
-    def extract_from_pdf(self, pdf_input, output_path=None):
+        try:
+            response = await self._annotate_batch_async(client, self._ocr_requests(batch))
+        except Exception as e:
+            return {}, dict.fromkeys((img_hash for img_hash, _ in batch), str(e))
+        return await asyncio.to_thread(self._read_ocr_response, batch, response)
+    
+    def process_page(self, page, page_num, matrix=DPI_MATRIX):
         """
-        Traite le PDF page par page en décidant de la meilleure stratégie
-        Accepte soit un chemin (str), soit des bytes
+        Traite une page en décidant de la meilleure stratégie
+        L'OCR n'est pas lancé ici : retourne (page_data, img_bytes), img_bytes
+        étant l'image à passer à l'OCR (None si la page n'en a pas besoin)
+        """
+        page_data = {
+            'page_number': page_num + 1,
+            'text': '',
+            'method': '',
+            'has_images': False
+        }
+        
+        # Vérifier s'il y a du texte extractible (extrait une seule fois,
+        # puis réutilisé par les cas texte direct et hybride)
+        text = self.extract_text_from_pdf(page)
+        has_text = self.has_extractable_text(text)
+        has_imgs = self._needs_ocr(page)
+        
+        page_data['has_images'] = has_imgs
+        img_bytes = None
+        clip = None
+        
+        # Sur une page avec du texte, seules les images significatives passent
+        # par l'OCR, et l'image rendue est limitée à la zone qu'elles couvrent
+        if has_text and has_imgs:
+            clip = self._image_region(page)
+            has_imgs = clip is not None
+        
+        # Décision : quelle méthode utiliser ?
+        if has_text and not has_imgs:
+            # Cas 1 : Seulement du texte → extraction directe (RAPIDE)
+            page_data['text'] = text
+            page_data['method'] = 'direct_text'
+            print(f"✓ Page {page_num + 1} : Texte direct")
+            
+        elif has_imgs and not has_text:
+            # Cas 2 : Seulement des images → OCR complet
+            print(f"🔍 Page {page_num + 1} : Utilisation de l'OCR (images détectées)...")
+            img_bytes = self._render_page_image(page, matrix)
+            page_data['method'] = 'ocr_only'
+            
+        elif has_text and has_imgs:
+            # Cas 3 : HYBRIDE - texte + images → combiner les deux
+            print(f"🔀 Page {page_num + 1} : Mode hybride (texte + images)...")
+            
+            # Extraire le texte direct (combiné avec l'OCR une fois le lot traité)
+            page_data['text'] = text
+            img_bytes = self._render_page_image(page, matrix, clip)
+            page_data['method'] = 'hybrid'
+            
+        else:
+            # Cas 4 : Page vide
+            page_data['text'] = ""
+            page_data['method'] = 'empty'
+            print(f"⚠️  Page {page_num + 1} : Vide")
+        
+        return page_data, img_bytes
+    
+    def _classify_pages(self, pdf_bytes, n_pages, matrix):
+        """
+        Phase 1 : classe toutes les pages (texte direct extrait, images rendues
+        pour l'OCR) et produit les (page_data, img_bytes) dans l'ordre, au fur
+        et à mesure - les gros documents sont répartis sur un pool de processus
+        """
+        if n_pages < PARALLEL_MIN_PAGES:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                for page_num in range(n_pages):
+                    yield self.process_page(doc[page_num], page_num, matrix)
+            return
+        
+        # Le PDF est transmis une seule fois à chaque worker (initializer),
+        # la matrice sous forme de tuple pour être sérialisable
+        max_workers = min(os.cpu_count() or 1, MAX_WORKERS)
+        with _POOL_SLOTS, ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=_MP_CONTEXT,
+            initializer=_init_worker,
+            initargs=(pdf_bytes, tuple(matrix))
+        ) as executor:
+            yield from executor.map(_process_page, range(n_pages), chunksize=4)
+    
+    def _load_pdf(self, pdf_input):
+        """
+        Lit le PDF (chemin ou bytes) et prépare les statistiques
+        Retourne (pdf_bytes, stats)
         """
         # Adapter pour accepter bytes OU chemin
         if isinstance(pdf_input, bytes):
-            doc = fitz.open(stream=pdf_input, filetype="pdf")
+            pdf_bytes = pdf_input
         else:
-            doc = fitz.open(pdf_input)
+            with open(pdf_input, 'rb') as f:
+                pdf_bytes = f.read()
+        
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            n_pages = len(doc)
         
-        # IMPORTANT: Ce code doit être AU MÊME NIVEAU que le if/else ci-dessus
-        results = []
         stats = {
-            'total_pages': len(doc),
+            'total_pages': n_pages,
             'text_extracted': 0,
             'ocr_used': 0,
             'hybrid': 0,
-            'empty': 0
+            'empty': 0,
+            'ocr_errors': 0,
+            'ocr_cache_hits': 0,
+            'ocr_cache_misses': 0,
+            'blank_skipped': 0
         }
         
-        print(f"📄 Traitement de {len(doc)} pages...\n")
+        print(f"📄 Traitement de {n_pages} pages...\n")
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            page_data = {
-                'page_number': page_num + 1,
-                'text': '',
-                'method': '',
-                'has_images': False
-            }
-            
-            # Vérifier s'il y a du texte extractible
-            has_text = self.has_extractable_text(page)
-            has_imgs = self.has_images(page)
-            
-            page_data['has_images'] = has_imgs
-            
-            # Décision : quelle méthode utiliser ?
-            if has_text and not has_imgs:
-                # Cas 1 : Seulement du texte → extraction directe (RAPIDE)
-                page_data['text'] = self.extract_text_from_pdf(page)
-                page_data['method'] = 'direct_text'
-                stats['text_extracted'] += 1
-                print(f"✓ Page {page_num + 1} : Texte direct")
-                
-            elif has_imgs and not has_text:
-                # Cas 2 : Seulement des images → OCR complet
-                print(f"🔍 Page {page_num + 1} : Utilisation de l'OCR (images détectées)...")
-                page_data['text'] = self.extract_text_from_image_ocr(page, page_num)
-                page_data['method'] = 'ocr_only'
-                stats['ocr_used'] += 1
+        return pdf_bytes, stats
+    
+    def _classify_and_dispatch(self, pdf_bytes, stats, matrix, dispatch):
+        """
+        Classe les pages et lance l'OCR au fil de l'eau : les images déjà
+        traitées (cache, ou déjà vues dans ce document) sont écartées, et dès
+        que OCR_BATCH_SIZE images restent à reconnaître, elles sont confiées
+        à dispatch (qui retourne un Future) pendant que le rendu des pages
+        suivantes continue - une image n'est envoyée qu'une fois, y compris
+        quand une autre extraction la reconnaît déjà (son Future est repris)
+        Retourne (results, {page_num: img_hash}, textes en cache, futures)
+        """
+        results = []
+        page_hashes = {}
+        cached_texts = {}
+        ocr_futures = []
+        seen = set()
+        pending = []
+        
+        try:
+            for page_data, img_bytes in self._classify_pages(pdf_bytes, stats['total_pages'], matrix):
+                results.append(page_data)
+                stats[METHOD_STATS[page_data['method']]] += 1
                 
-            elif has_text and has_imgs:
-                # Cas 3 : HYBRIDE - texte + images → combiner les deux
-                print(f"🔀 Page {page_num + 1} : Mode hybride (texte + images)...")
+                if img_bytes is None:
+                    if page_data['method'] in ('ocr_only', 'hybrid'):
+                        stats['blank_skipped'] += 1
+                        print(f"⚪ Page {page_data['page_number']} : Image blanche, OCR ignoré")
+                    continue
                 
-                # Extraire le texte direct
-                direct_text = self.extract_text_from_pdf(page)
+                img_hash = hashlib.sha256(img_bytes).hexdigest()
+                page_hashes[page_data['page_number'] - 1] = img_hash
+                if img_hash in seen:
+                    stats['ocr_cache_hits'] += 1
+                    continue
+                seen.add(img_hash)
                 
-                # Extraire le texte des images via OCR
-                ocr_text = self.extract_text_from_image_ocr(page, page_num)
+                cached = self._get_cached_ocr(img_hash)
+                if cached is not None:
+                    cached_texts[img_hash] = cached
+                    stats['ocr_cache_hits'] += 1
+                    continue
                 
-                # Combiner intelligemment
-                page_data['text'] = self.merge_text_and_ocr(direct_text, ocr_text)
-                page_data['method'] = 'hybrid'
-                stats['hybrid'] += 1
+                # Déjà envoyée par une autre extraction : rien à payer ici
+                shared = self._claim_ocr(img_hash)
+                if shared is not None:
+                    ocr_futures.append(shared)
+                    stats['ocr_cache_hits'] += 1
+                    continue
                 
-            else:
-                # Cas 4 : Page vide
-                page_data['text'] = ""
-                page_data['method'] = 'empty'
-                stats['empty'] += 1
-                print(f"⚠️  Page {page_num + 1} : Vide")
+                stats['ocr_cache_misses'] += 1
+                pending.append((img_hash, img_bytes))
+                if len(pending) == OCR_BATCH_SIZE:
+                    print(f"\n🔍 OCR lancé pour {len(pending)} image(s)...")
+                    ocr_futures.append(self._dispatch_ocr(dispatch, pending))
+                    pending = []
             
-            results.append(page_data)
+            if pending:
+                print(f"\n🔍 OCR lancé pour {len(pending)} image(s)...")
+                ocr_futures.append(self._dispatch_ocr(dispatch, pending))
+        except BaseException as e:
+            # Les images réservées mais jamais envoyées ne doivent pas
+            # bloquer les extractions qui les attendent
+            self._release_ocr(pending, {}, dict.fromkeys((img_hash for img_hash, _ in pending), str(e)))
+            raise
         
-        doc.close()
+        return results, page_hashes, cached_texts, ocr_futures
+    
+    def _page_ocr_texts(self, page_hashes, ocr_texts, ocr_errors, stats):
+        """
+        Associe à chaque page le texte OCR de son image (ou son erreur)
+        Retourne {page_num: texte}
+        """
+        texts = {}
+        for page_num, img_hash in page_hashes.items():
+            if img_hash in ocr_texts:
+                texts[page_num] = ocr_texts[img_hash]
+                continue
+            
+            error = ocr_errors.get(img_hash)
+            if error is None:
+                texts[page_num] = "[OCR non disponible - Vision API non configurée]"
+            else:
+                texts[page_num] = f"[Erreur OCR page {page_num + 1}: {error}]"
+            stats['ocr_errors'] += 1
+        return texts
+    
+    def _collect_ocr(self, page_hashes, cached_texts, ocr_batches, stats):
+        """
+        Réunit les textes en cache et les résultats des lots OCR
+        Retourne {page_num: texte}
+        """
+        ocr_texts = dict(cached_texts)
+        ocr_errors = {}
+        for texts, errors in ocr_batches:
+            ocr_texts.update(texts)
+            ocr_errors.update(errors)
+        return self._page_ocr_texts(page_hashes, ocr_texts, ocr_errors, stats)
+    
+    def _finalize(self, results, ocr_texts, stats, output_path):
+        """
+        Intègre le texte OCR aux pages, assemble le texte complet et affiche
+        les statistiques - retourne (full_text, results, stats)
+        """
+        for page_data in results:
+            ocr_text = ocr_texts.get(page_data['page_number'] - 1)
+            if ocr_text is None:
+                continue
+            if page_data['method'] == 'hybrid':
+                # Combiner intelligemment
+                page_data['text'] = self.merge_text_and_ocr(page_data['text'], ocr_text)
+            else:
+                page_data['text'] = ocr_text
         
         # Assembler le texte complet dans l'ordre
         full_text = self.assemble_full_text(results)
@@ -158,23 +706,74 @@ class HybridPDFExtractor:
         print(f"OCR utilisé : {stats['ocr_used']} pages")
         print(f"Mode hybride : {stats['hybrid']} pages")
         print(f"Pages vides : {stats['empty']} pages")
-        print(f"\n💰 Coût estimé OCR : ${(stats['ocr_used'] + stats['hybrid']) * 0.0015:.2f}")
+        print(f"Cache OCR : {stats['ocr_cache_hits']} hits / {stats['ocr_cache_misses']} misses")
+        print(f"Pages blanches (OCR ignoré) : {stats['blank_skipped']} pages")
+        print(f"\n💰 Coût estimé OCR : ${stats['ocr_cache_misses'] * OCR_COST_PER_IMAGE:.2f}")
         
         return full_text, results, stats
     
+    def extract_from_pdf(self, pdf_input, output_path=None, matrix=DPI_MATRIX):
+        """
+        Traite le PDF page par page en décidant de la meilleure stratégie
+        Accepte soit un chemin (str), soit des bytes
+        matrix : zoom de rendu des pages passées à l'OCR (DPI_MATRIX par défaut)
+        Phase 1 : classement des pages - Phase 2 : OCR par lots, lancé pendant
+        que les pages suivantes sont encore en cours de rendu
+        """
+        pdf_bytes, stats = self._load_pdf(pdf_input)
+        
+        with ThreadPoolExecutor(max_workers=OCR_PIPELINE_WORKERS) as ocr_pool:
+            results, page_hashes, cached_texts, ocr_futures = self._classify_and_dispatch(
+                pdf_bytes, stats, matrix,
+                lambda batch: ocr_pool.submit(self._run_ocr_batch, batch)
+            )
+            ocr_batches = [future.result() for future in ocr_futures]
+        
+        ocr_texts = self._collect_ocr(page_hashes, cached_texts, ocr_batches, stats)
+        return self._finalize(results, ocr_texts, stats, output_path)
+    
+    async def extract_from_pdf_async(self, pdf_input, output_path=None, matrix=DPI_MATRIX):
+        """
+        Version asynchrone de extract_from_pdf : le classement des pages tourne
+        dans un thread et les lots OCR sont envoyés en parallèle via le client
+        Vision asynchrone, sans bloquer la boucle d'événements
+        """
+        loop = asyncio.get_running_loop()
+        pdf_bytes, stats = await asyncio.to_thread(self._load_pdf, pdf_input)
+        
+        # Place de pool prise avant d'entrer dans le thread de classement
+        if stats['total_pages'] >= PARALLEL_MIN_PAGES:
+            pool_slot = self._pool_slots
+        else:
+            pool_slot = contextlib.nullcontext()
+        async with pool_slot:
+            # Les lots OCR sont lancés dans la boucle depuis le thread de classement
+            results, page_hashes, cached_texts, ocr_futures = await asyncio.to_thread(
+                self._classify_and_dispatch, pdf_bytes, stats, matrix,
+                lambda batch: asyncio.run_coroutine_threadsafe(self._run_ocr_batch_async(batch), loop)
+            )
+        ocr_batches = await asyncio.gather(*[asyncio.wrap_future(future) for future in ocr_futures])
+        
+        ocr_texts = self._collect_ocr(page_hashes, cached_texts, ocr_batches, stats)
+        return await asyncio.to_thread(self._finalize, results, ocr_texts, stats, output_path)
+    
     def merge_text_and_ocr(self, direct_text, ocr_text):
         """
         Combine le texte direct avec le texte de l'OCR de manière intelligente
         """
-        # Diviser en lignes
-        direct_lines = set(line.strip() for line in direct_text.split('\n') if line.strip())
+        # Diviser en lignes (normalisées pour le texte direct)
+        direct_norm = {_normalize_line(line) for line in direct_text.split('\n') if line.strip()}
         ocr_lines = [line.strip() for line in ocr_text.split('\n') if line.strip()]
         
+        # Un seul bloc pour tester l'inclusion d'une ligne OCR dans une ligne
+        # directe en une recherche, au lieu de parcourir toutes les lignes
+        direct_blob = "\n".join(direct_norm)
+        
         # Ajouter les lignes de l'OCR qui ne sont pas dans le texte direct
         additional_lines = []
         for ocr_line in ocr_lines:
-            if not any(ocr_line in direct_line or direct_line in ocr_line 
-                    for direct_line in direct_lines):
+            norm = _normalize_line(ocr_line)
+            if norm not in direct_norm and norm not in direct_blob:
                 additional_lines.append(ocr_line)
         
         # Combiner SANS marqueur [CONTENU DES IMAGES/TABLEAUX]
@@ -190,14 +789,9 @@ class HybridPDFExtractor:
         Assemble le texte SANS séparateurs de page pour une meilleure comparaison
         Identique au comportement de Streamlit
         """
-        full_text_parts = []
-        
-        for page_data in results:
-            text = page_data['text'].strip()
-            if text:
-                full_text_parts.append(text)
-        
-        return "\n\n".join(full_text_parts)
+        return "\n\n".join(
+            text for page_data in results if (text := page_data['text'].strip())
+        )
 
 
 # ============================================
@@ -1,12 +1,15 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Optional
+import asyncio
 import tempfile
 import os
 import re
-import difflib
-from hybrid_extractor import HybridPDFExtractor
-from google.cloud import vision
+import json
+import hashlib
+from hybrid_extractor import HybridPDFExtractor, OCR_COST_PER_IMAGE
+from paragraph_diff import render_html_diff
 
 app = FastAPI(title="PDF Comparator API")
 
@@ -19,14 +22,161 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inicializar o extrator
-try:
-    vision_client = vision.ImageAnnotatorClient()
-except Exception as e:
-    print(f"⚠️ Vision API non disponible: {e}")
-    vision_client = None
+# Inicializar o extrator (le client Vision asynchrone est créé à la première
+# extraction, dans la boucle d'événements du serveur)
+extractor = HybridPDFExtractor()
 
-extractor = HybridPDFExtractor(vision_client=vision_client)
+# Cache des extractions complètes, indexé par l'empreinte du PDF envoyé
+EXTRACT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdf-comparator-cache")
+
+# Version du format des extractions en cache : à incrémenter dès que
+# l'extracteur produit un résultat différent (texte, pages ou statistiques),
+# les anciennes entrées ne sont alors plus lues
+EXTRACT_CACHE_VERSION = 1
+
+# Nombre d'extractions gardées sur disque (les plus récemment utilisées)
+EXTRACT_CACHE_MAX_FILES = 256
+
+# Extractions en cours (chemin de cache -> tâche) : un même fichier envoyé
+# deux fois en même temps, dans une requête ou deux, n'est extrait qu'une fois
+_pending_extractions = {}
+
+
+def extraction_cache_path(content: bytes) -> str:
+    """
+    Chemin du cache d'extraction d'un fichier (clé : empreinte blake2b du contenu).
+    """
+    key = hashlib.blake2b(content, digest_size=16).hexdigest()
+    return os.path.join(EXTRACT_CACHE_DIR, f"v{EXTRACT_CACHE_VERSION}-{key}.json")
+
+
+def served_from_cache(stats: dict) -> dict:
+    """
+    Statistiques d'une extraction réutilisée : aucune image n'est envoyée à
+    Vision pour cette requête, les images OCR comptent comme servies depuis
+    le cache (coût nul).
+    """
+    return {
+        **stats,
+        'ocr_cache_hits': stats['ocr_cache_hits'] + stats['ocr_cache_misses'],
+        'ocr_cache_misses': 0
+    }
+
+
+def load_cached_extraction(cache_path: str):
+    """
+    Cherche l'extraction d'un envoi précédent du même fichier.
+    Retourne le résultat, ou None s'il est absent ou illisible.
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        full_text, page_results, stats = cached['full_text'], cached['page_results'], cached['stats']
+        # Entrée incomplète ou d'un autre format : traitée comme absente
+        # (ValidationError est une ValueError)
+        if not isinstance(full_text, str) or set(stats) != set(ExtractionStats.model_fields):
+            return None
+        ExtractionStats.model_validate(stats)
+        for page in page_results:
+            PageInfo.model_validate(page)
+        # Garde l'entrée parmi les plus récentes pour le nettoyage du cache
+        os.utime(cache_path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    
+    print(f"♻️ Extraction servie depuis le cache ({os.path.basename(cache_path)})")
+    return full_text, page_results, served_from_cache(stats)
+
+
+def prune_extraction_cache():
+    """
+    Supprime les extractions les moins récemment utilisées au-delà de
+    EXTRACT_CACHE_MAX_FILES.
+    """
+    entries = []
+    with os.scandir(EXTRACT_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith('.json'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+    
+    entries.sort(reverse=True)
+    for _, path in entries[EXTRACT_CACHE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def save_extraction(cache_path: str, full_text: str, page_results: list, stats: dict):
+    """
+    Enregistre une extraction dans le cache (écriture atomique).
+    """
+    try:
+        os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=EXTRACT_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({
+                "full_text": full_text,
+                "page_results": page_results,
+                "stats": stats
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+        prune_extraction_cache()
+    except OSError as e:
+        print(f"⚠️ Cache d'extraction non écrit: {e}")
+
+
+async def extract_with_cache(content: bytes):
+    """
+    Extrait le texte d'un PDF, ou réutilise le résultat d'un envoi précédent
+    du même fichier (ou l'extraction en cours du même fichier). L'OCR passe
+    par le client Vision asynchrone.
+    """
+    cache_path = await asyncio.to_thread(extraction_cache_path, content)
+    
+    pending = _pending_extractions.get(cache_path)
+    if pending is not None:
+        # shield : l'annulation d'une requête n'interrompt pas les autres
+        full_text, page_results, stats = await asyncio.shield(pending)
+        return full_text, page_results, served_from_cache(stats)
+    
+    pending = asyncio.ensure_future(extract_and_cache(cache_path, content))
+    _pending_extractions[cache_path] = pending
+    pending.add_done_callback(lambda _: _pending_extractions.pop(cache_path, None))
+    return await asyncio.shield(pending)
+
+
+async def extract_and_cache(cache_path: str, content: bytes):
+    """
+    Lit l'extraction en cache, ou extrait le PDF et enregistre le résultat.
+    """
+    cached = await asyncio.to_thread(load_cached_extraction, cache_path)
+    if cached is not None:
+        return cached
+    
+    full_text, page_results, stats = await extractor.extract_from_pdf_async(content)
+    
+    # Ne pas garder en cache un résultat dont l'OCR a échoué
+    if not stats['ocr_errors']:
+        await asyncio.to_thread(save_extraction, cache_path, full_text, page_results, stats)
+    
+    return full_text, page_results, stats
+
+
+def page_metadata(page_results: list, include_page_text: bool) -> list:
+    """
+    Retourne les métadonnées des pages, sans leur texte (déjà présent dans
+    le texte complet) sauf si l'appelant le demande explicitement.
+    """
+    if include_page_text:
+        return page_results
+    return [{k: v for k, v in p.items() if k != 'text'} for p in page_results]
+
+
+_WS_RE = re.compile(r'\s+')
 
 
 def clean_text_advanced(text: str) -> str:
@@ -38,13 +188,86 @@ def clean_text_advanced(text: str) -> str:
     for line in text.splitlines():
         stripped_line = line.strip()
         # Ignorer les lignes qui sont uniquement des numéros ou trop courtes
-        if not re.fullmatch(r'\d+', stripped_line) and len(stripped_line) > 2:
+        if not stripped_line.isdecimal() and len(stripped_line) > 2:
             # Normaliser les espaces
-            normalized_line = re.sub(r'\s+', ' ', stripped_line)
+            normalized_line = _WS_RE.sub(' ', stripped_line)
             cleaned_lines.append(normalized_line)
     return "\n".join(cleaned_lines)
 
 
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+
+
+def clean_paragraphs(text: str) -> list:
+    """
+    Découpe le texte extrait en paragraphes (blocs séparés par une ligne vide)
+    nettoyés avec clean_text_advanced. Les lignes vides étant supprimées par
+    le nettoyage, "\n".join() du résultat vaut clean_text_advanced(text).
+    """
+    paragraphs = (clean_text_advanced(p) for p in _PARAGRAPH_RE.split(text))
+    return [p for p in paragraphs if p]
+
+
+# Squelette statique du diff HTML (mêmes styles et légende que HtmlDiff.make_file)
+# Modèles des réponses : avec un type de retour déclaré, FastAPI sérialise
+# directement en JSON via Pydantic (rapide, sans classe de réponse dédiée)
+class PageInfo(BaseModel):
+    page_number: int
+    method: str
+    has_images: bool
+    text: Optional[str] = None  # Seulement avec include_page_text
+
+
+class ExtractionStats(BaseModel):
+    total_pages: int
+    text_extracted: int
+    ocr_used: int
+    hybrid: int
+    empty: int
+    ocr_errors: int
+    ocr_cache_hits: int
+    ocr_cache_misses: int
+    blank_skipped: int
+
+
+class ExtractResponse(BaseModel):
+    success: bool
+    filename: str
+    text: str
+    pages: list[PageInfo]
+    stats: ExtractionStats
+
+
+class FileComparison(BaseModel):
+    filename: str
+    text: str
+    pages: list[PageInfo]
+    stats: ExtractionStats
+
+
+class CompareResponse(BaseModel):
+    success: bool
+    file1: FileComparison
+    file2: FileComparison
+
+
+class CompareHtmlStats(BaseModel):
+    file1: ExtractionStats
+    file2: ExtractionStats
+    total_pages: int
+    total_ocr_pages: int
+    estimated_cost: str
+
+
+class CompareHtmlResponse(BaseModel):
+    success: bool
+    html: str
+    is_identical: bool
+    text1: str  # Texte nettoyé pour le PDF annoté
+    text2: str  # Texte nettoyé pour le PDF annoté
+    stats: CompareHtmlStats
+
+
 @app.get("/")
 def read_root():
     return {
@@ -58,44 +281,38 @@ def read_root():
     }
 
 
-@app.post("/api/extract")
-async def extract_pdf(file: UploadFile = File(...)):
+@app.post("/api/extract", response_model_exclude_none=True)
+async def extract_pdf(file: UploadFile = File(...), include_page_text: bool = False) -> ExtractResponse:
     """
     Extrai texto de um único PDF usando o método híbrido (texto direto + OCR)
     """
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-        content = await file.read()
-        tmp_file.write(content)
-        tmp_path = tmp_file.name
+    content = await file.read()
     
     try:
-        full_text, page_results, stats = extractor.extract_from_pdf(tmp_path)
+        full_text, page_results, stats = await extract_with_cache(content)
         full_text = clean_text_advanced(full_text)
         
-        return JSONResponse(content={
-            "success": True,
-            "filename": file.filename,
-            "text": full_text,
-            "pages": page_results,
-            "stats": stats
-        })
+        return ExtractResponse(
+            success=True,
+            filename=file.filename,
+            text=full_text,
+            pages=page_metadata(page_results, include_page_text),
+            stats=stats
+        )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
-    
-    finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
 
 
-@app.post("/api/compare")
+@app.post("/api/compare", response_model_exclude_none=True)
 async def compare_pdfs(
     file1: UploadFile = File(...),
-    file2: UploadFile = File(...)
-):
+    file2: UploadFile = File(...),
+    include_page_text: bool = False
+) -> CompareResponse:
     """
     Compara dois PDFs e retorna:
     - Texto extraído de cada um (nettoyé)
@@ -105,60 +322,48 @@ async def compare_pdfs(
     if not file1.filename.endswith('.pdf') or not file2.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp1:
-        content1 = await file1.read()
-        tmp1.write(content1)
-        tmp1_path = tmp1.name
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp2:
-        content2 = await file2.read()
-        tmp2.write(content2)
-        tmp2_path = tmp2.name
+    content1 = await file1.read()
+    content2 = await file2.read()
     
     try:
-        print(f"🔍 Extracting text from {file1.filename}...")
-        text1, pages1, stats1 = extractor.extract_from_pdf(tmp1_path)
-        
-        print(f"🔍 Extracting text from {file2.filename}...")
-        text2, pages2, stats2 = extractor.extract_from_pdf(tmp2_path)
+        # Les deux extractions sont indépendantes : les lancer en parallèle
+        print(f"🔍 Extracting text from {file1.filename} and {file2.filename}...")
+        (text1, pages1, stats1), (text2, pages2, stats2) = await asyncio.gather(
+            extract_with_cache(content1),
+            extract_with_cache(content2)
+        )
         
         text1 = clean_text_advanced(text1)
         text2 = clean_text_advanced(text2)
         
-        return JSONResponse(content={
-            "success": True,
-            "file1": {
-                "filename": file1.filename,
-                "text": text1,
-                "pages": pages1,
-                "stats": stats1
-            },
-            "file2": {
-                "filename": file2.filename,
-                "text": text2,
-                "pages": pages2,
-                "stats": stats2
-            }
-        })
+        return CompareResponse(
+            success=True,
+            file1=FileComparison(
+                filename=file1.filename,
+                text=text1,
+                pages=page_metadata(pages1, include_page_text),
+                stats=stats1
+            ),
+            file2=FileComparison(
+                filename=file2.filename,
+                text=text2,
+                pages=page_metadata(pages2, include_page_text),
+                stats=stats2
+            )
+        )
     
     except Exception as e:
         raise HTTPException(
             status_code=500, 
             detail=f"Error comparing PDFs: {str(e)}"
         )
-    
-    finally:
-        if os.path.exists(tmp1_path):
-            os.unlink(tmp1_path)
-        if os.path.exists(tmp2_path):
-            os.unlink(tmp2_path)
 
 
 @app.post("/api/compare-html")
 async def compare_pdfs_html(
     file1: UploadFile = File(...),
     file2: UploadFile = File(...)
-):
+) -> CompareHtmlResponse:
     """
     Compare deux PDFs et retourne un diff HTML identique à Streamlit.
     Utilise difflib.HtmlDiff pour un rendu côte à côte optimisé.
@@ -166,74 +371,63 @@ async def compare_pdfs_html(
     if not file1.filename.endswith('.pdf') or not file2.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp1:
-        content1 = await file1.read()
-        tmp1.write(content1)
-        tmp1_path = tmp1.name
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp2:
-        content2 = await file2.read()
-        tmp2.write(content2)
-        tmp2_path = tmp2.name
+    content1 = await file1.read()
+    content2 = await file2.read()
     
     try:
-        print(f"🔍 Extracting text from {file1.filename}...")
-        text1, pages1, stats1 = extractor.extract_from_pdf(tmp1_path)
-        
-        print(f"🔍 Extracting text from {file2.filename}...")
-        text2, pages2, stats2 = extractor.extract_from_pdf(tmp2_path)
+        # Les deux extractions sont indépendantes : les lancer en parallèle
+        print(f"🔍 Extracting text from {file1.filename} and {file2.filename}...")
+        (text1, pages1, stats1), (text2, pages2, stats2) = await asyncio.gather(
+            extract_with_cache(content1),
+            extract_with_cache(content2)
+        )
         
-        # Nettoyer le texte comme Streamlit
-        text1 = clean_text_advanced(text1)
-        text2 = clean_text_advanced(text2)
+        # Nettoyer le texte comme Streamlit, paragraphe par paragraphe
+        paragraphs1 = clean_paragraphs(text1)
+        paragraphs2 = clean_paragraphs(text2)
+        text1 = "\n".join(paragraphs1)
+        text2 = "\n".join(paragraphs2)
         
-        # Générer le diff HTML avec difflib (IDENTIQUE à Streamlit)
-        lines1 = text1.splitlines()
-        lines2 = text2.splitlines()
+        # Vérifier si les documents sont identiques (avant le calcul du diff)
+        is_identical = text1.strip() == text2.strip()
         
-        html_diff = difflib.HtmlDiff(wrapcolumn=80).make_file(
-            lines1,
-            lines2,
+        # Générer le diff HTML avec difflib, aligné par paragraphes
+        html_diff = render_html_diff(
+            paragraphs1,
+            paragraphs2,
             fromdesc=f"{file1.filename} (contenu complet)",
-            todesc=f"{file2.filename} (contenu complet)"
+            todesc=f"{file2.filename} (contenu complet)",
+            is_identical=is_identical
         )
         
-        # Calculer les statistiques de coût
+        # Calculer les statistiques de coût : pages passées par l'OCR (hors
+        # pages blanches), coût selon les images réellement envoyées à Vision
         total_ocr_pages = (
-            stats1['ocr_used'] + stats1['hybrid'] + 
-            stats2['ocr_used'] + stats2['hybrid']
+            stats1['ocr_used'] + stats1['hybrid'] - stats1['blank_skipped'] +
+            stats2['ocr_used'] + stats2['hybrid'] - stats2['blank_skipped']
         )
-        total_cost = total_ocr_pages * 0.0015
-        
-        # Vérifier si les documents sont identiques
-        is_identical = text1.strip() == text2.strip()
+        total_cost = (stats1['ocr_cache_misses'] + stats2['ocr_cache_misses']) * OCR_COST_PER_IMAGE
         
-        return JSONResponse(content={
-            "success": True,
-            "html": html_diff,
-            "is_identical": is_identical,
-            "text1": text1,  # Texte nettoyé pour le PDF annoté
-            "text2": text2,  # Texte nettoyé pour le PDF annoté
-            "stats": {
-                "file1": stats1,
-                "file2": stats2,
-                "total_pages": stats1['total_pages'] + stats2['total_pages'],
-                "total_ocr_pages": total_ocr_pages,
-                "estimated_cost": f"${total_cost:.4f}"
-            }
-        })
+        return CompareHtmlResponse(
+            success=True,
+            html=html_diff,
+            is_identical=is_identical,
+            text1=text1,
+            text2=text2,
+            stats=CompareHtmlStats(
+                file1=stats1,
+                file2=stats2,
+                total_pages=stats1['total_pages'] + stats2['total_pages'],
+                total_ocr_pages=total_ocr_pages,
+                estimated_cost=f"${total_cost:.4f}"
+            )
+        )
     
     except Exception as e:
         raise HTTPException(
             status_code=500, 
             detail=f"Error comparing PDFs: {str(e)}"
         )
-    
-    finally:
-        if os.path.exists(tmp1_path):
-            os.unlink(tmp1_path)
-        if os.path.exists(tmp2_path):
-            os.unlink(tmp2_path)
 
 
 @app.get("/health")
@@ -0,0 +1,156 @@
+import difflib
+import sys
+
+# ParagraphHtmlDiff reprend le rendu de HtmlDiff.make_table et s'appuie sur
+# l'API privée de difflib :
+#   - difflib._mdiff
+#   - HtmlDiff._tab_newline_replace, _make_prefix, _line_wrapper,
+#     _collect_lines, _convert_flags, _table_template
+#   - attributs posés par HtmlDiff : _prefix, _linejunk, _charjunk, _wrapcolumn
+# Ces éléments sont identiques de CPython 3.8 à 3.13. Sur une autre version
+# (à vérifier avant d'élargir l'intervalle), ou si l'un d'eux manque, le diff
+# revient à HtmlDiff.make_table sur les lignes complètes : même rendu, mais
+# tout le document est comparé ligne à ligne (plus lent)
+PARAGRAPH_DIFF_SUPPORTED = (
+    (3, 8) <= sys.version_info[:2] <= (3, 13)
+    and hasattr(difflib, '_mdiff')
+    and all(hasattr(difflib.HtmlDiff, name) for name in (
+        '_tab_newline_replace', '_make_prefix', '_line_wrapper',
+        '_collect_lines', '_convert_flags', '_table_template'
+    ))
+)
+
+_HTML_DIFF_TEMPLATE = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+          "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html>
+<head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+    <title></title>
+    <style type="text/css">
+        table.diff {font-family:Courier; border:medium;}
+        .diff_header {background-color:#e0e0e0}
+        td.diff_header {text-align:right}
+        .diff_next {background-color:#c0c0c0}
+        .diff_add {background-color:#aaffaa}
+        .diff_chg {background-color:#ffff77}
+        .diff_sub {background-color:#ffaaaa}
+    </style>
+</head>
+<body>
+    %(table)s
+    <table class="diff" summary="Legends">
+        <tr> <th colspan="2"> Legends </th> </tr>
+        <tr> <td> <table border="" summary="Colors">
+                      <tr><th> Colors </th> </tr>
+                      <tr><td class="diff_add">&nbsp;Added&nbsp;</td></tr>
+                      <tr><td class="diff_chg">Changed</td> </tr>
+                      <tr><td class="diff_sub">Deleted</td> </tr>
+                  </table></td>
+             <td> <table border="" summary="Links">
+                      <tr><th colspan="2"> Links </th> </tr>
+                      <tr><td>(f)irst change</td> </tr>
+                      <tr><td>(n)ext change</td> </tr>
+                      <tr><td>(t)op</td> </tr>
+                  </table></td> </tr>
+    </table>
+</body>
+</html>
+"""
+
+
+class ParagraphHtmlDiff(difflib.HtmlDiff):
+    """
+    HtmlDiff calculé par paragraphes : les paragraphes des deux documents sont
+    d'abord alignés entre eux, puis seuls les blocs modifiés sont comparés
+    ligne à ligne. Même rendu que HtmlDiff.make_table (diff complet).
+    """
+    
+    def _paragraph_mdiff(self, fromparas, toparas):
+        """
+        Équivalent de difflib._mdiff sur des listes de paragraphes
+        """
+        matcher = difflib.SequenceMatcher(None, fromparas, toparas, autojunk=False)
+        from_offset = to_offset = 0
+        
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            fromlines, tolines = self._tab_newline_replace(
+                [line for para in fromparas[i1:i2] for line in para.splitlines()],
+                [line for para in toparas[j1:j2] for line in para.splitlines()]
+            )
+            
+            if tag == 'equal':
+                for num, line in enumerate(fromlines, 1):
+                    yield (from_offset + num, line), (to_offset + num, line), False
+            else:
+                # Diff ligne à ligne limité aux paragraphes modifiés, numéros
+                # de ligne décalés pour rester ceux du document complet
+                for (from_num, from_text), (to_num, to_text), flag in difflib._mdiff(
+                    fromlines, tolines, linejunk=self._linejunk, charjunk=self._charjunk
+                ):
+                    if from_num != '':
+                        from_num += from_offset
+                    if to_num != '':
+                        to_num += to_offset
+                    yield (from_num, from_text), (to_num, to_text), flag
+            
+            from_offset += len(fromlines)
+            to_offset += len(tolines)
+    
+    def make_paragraph_table(self, fromparas, toparas, fromdesc='', todesc=''):
+        """
+        Retourne la table HTML côte à côte de deux listes de paragraphes
+        (reprend le rendu de HtmlDiff.make_table)
+        """
+        self._make_prefix()
+        
+        diffs = self._paragraph_mdiff(fromparas, toparas)
+        if self._wrapcolumn:
+            diffs = self._line_wrapper(diffs)
+        
+        fromlist, tolist, flaglist = self._collect_lines(diffs)
+        fromlist, tolist, flaglist, next_href, next_id = self._convert_flags(
+            fromlist, tolist, flaglist, False, 5)
+        
+        fmt = '            <tr><td class="diff_next"%s>%s</td>%s' + \
+              '<td class="diff_next">%s</td>%s</tr>\n'
+        rows = [
+            fmt % (next_id[i], next_href[i], fromlist[i], next_href[i], tolist[i])
+            for i in range(len(flaglist))
+        ]
+        header_row = '<thead><tr>%s%s%s%s</tr></thead>' % (
+            '<th class="diff_next"><br /></th>',
+            '<th colspan="2" class="diff_header">%s</th>' % fromdesc,
+            '<th class="diff_next"><br /></th>',
+            '<th colspan="2" class="diff_header">%s</th>' % todesc)
+        
+        table = self._table_template % dict(
+            data_rows=''.join(rows),
+            header_row=header_row,
+            prefix=self._prefix[1])
+        
+        return table.replace('\0+', '<span class="diff_add">'). \
+                     replace('\0-', '<span class="diff_sub">'). \
+                     replace('\0^', '<span class="diff_chg">'). \
+                     replace('\1', '</span>'). \
+                     replace('\t', '&nbsp;')
+
+
+def render_html_diff(paragraphs1: list, paragraphs2: list, fromdesc: str, todesc: str, is_identical: bool) -> str:
+    """
+    Génère le diff HTML côte à côte de deux documents découpés en paragraphes.
+    Le diff n'est pas calculé quand les documents sont identiques.
+    """
+    html_diff = ParagraphHtmlDiff(wrapcolumn=80)
+    
+    if is_identical:
+        table = html_diff.make_table([], [], fromdesc, todesc, context=True)
+    elif PARAGRAPH_DIFF_SUPPORTED:
+        table = html_diff.make_paragraph_table(paragraphs1, paragraphs2, fromdesc, todesc)
+    else:
+        table = html_diff.make_table(
+            [line for para in paragraphs1 for line in para.splitlines()],
+            [line for para in paragraphs2 for line in para.splitlines()],
+            fromdesc, todesc
+        )
+    
+    return _HTML_DIFF_TEMPLATE % {"table": table}